@@ -12,17 +12,30 @@ from sqlalchemy import text
 from .services.heatmap import *
 import math
 import osmnx as ox
-from .services.pathplanning import compute_final_route
+from .services.pathplanning import compute_final_route, build_node_index, apply_edge_weights, block_edge, load_or_build_graph
 # from data import *
-from shapely.geometry import Point, Polygon as ShapelyPolygon
+import numpy as np
+import shapely
+from shapely.geometry import Polygon as ShapelyPolygon
+from shapely.strtree import STRtree
 import json
+import time
 from datetime import datetime
 import requests
-from .services.snowflake import parse_cortex_sse, format_prompt, run_sql, snowflake_to_postgres
+from .services.snowflake import parse_cortex_sse, format_prompt, run_sql, run_sql_columnar, rows_to_columns, normalize_cortex_sql
 
 # Load environment variables
 load_dotenv()
 
+# Numeric severity for user-submitted report labels (built once, not per row)
+SEVERITY_MAP = {
+    'none': 1,
+    'low': 2,
+    'medium': 3,
+    'high': 4,
+    'critical': 5
+}
+
 # generalized response formats
 def success_response(data, code=200):
     return jsonify(data), code
@@ -71,8 +84,41 @@ def create_app():
         if not os.path.exists(GRAPH_PATH):
             raise FileNotFoundError(f"GraphML file not found at {GRAPH_PATH}")
 
-        app.nyc_graph = ox.load_graphml(GRAPH_PATH)
+        app.nyc_graph = load_or_build_graph(GRAPH_PATH)
+        app.nyc_node_index = build_node_index(app.nyc_graph)
+        apply_edge_weights(app.nyc_graph, app.blocked_edges_set)
         print(f"Loaded NYC graph from {GRAPH_PATH}")
+
+        # -------------------------------
+        # Cache neighborhood polygons at startup
+        # -------------------------------
+        NEIGHBORHOODS_PATH = os.path.join(BASE_DIR, 'data', 'nyc_neighborhoods.geojson')
+        with open(NEIGHBORHOODS_PATH, 'r') as f:
+            neighborhoods_geojson = json.load(f)
+
+        # (GeoJSON feature, prepared shapely polygon) pairs
+        app.neighborhoods = []
+        for feature in neighborhoods_geojson['features']:
+            if feature['geometry']['type'] != 'Polygon':
+                # Skip multipolygons for now (could be enhanced later)
+                continue
+            polygon_coords = feature['geometry']['coordinates'][0]  # First ring (exterior)
+            polygon = ShapelyPolygon([(coord[0], coord[1]) for coord in polygon_coords])
+            shapely.prepare(polygon)
+            app.neighborhoods.append((feature, polygon))
+        print(f"Cached {len(app.neighborhoods)} neighborhood polygons")
+
+        # -------------------------------
+        # Load the pothole model at startup
+        # -------------------------------
+        # Importing .model downloads the weights, builds the TensorRT engine if
+        # needed and runs the warm-up pass, so the first /api/analyze request in
+        # this worker doesn't pay for it
+        if app.config['PRELOAD_MODEL']:
+            try:
+                from . import model
+            except Exception as e:
+                print(f"Pothole model preload failed, retrying on first /api/analyze: {e}")
     
     # Base route
     @app.route('/')
@@ -195,7 +241,7 @@ def create_app():
                 graph=app.nyc_graph, 
                 origin=origin,
                 destination=destination, 
-                blocked_edges_set=app.blocked_edges_set)
+                node_index=app.nyc_node_index)
             
             if not route_coords:
                 return failure_response(
@@ -230,106 +276,86 @@ def create_app():
             #     return failure_response(f"DB Error: {str(e)}", 500)
 
             app.blocked_edges_set.add((u, v, k))
+            block_edge(app.nyc_graph, u, v, k)
             print(f"Blocked Edge added: {(u,v,k)}")
 
         return success_response({'success': True})
             
+    # Neighborhood stats scan every open issue; serve a recent result instead
+    # of recomputing on each map load
+    neighborhood_cache = {'response': None, 'expires_at': 0.0}
+
     @app.route('/api/neighborhood-boundaries', methods=['GET'])
     def get_neighborhood_boundaries():
         """Get NYC neighborhood boundaries with issue counts"""
+        if neighborhood_cache['response'] is not None and time.monotonic() < neighborhood_cache['expires_at']:
+            return jsonify(neighborhood_cache['response'])
+
         try:
-            
-            # Load the GeoJSON file
-            geojson_path = os.path.join(os.path.dirname(__file__), 'data', 'nyc_neighborhoods.geojson')
-            print(geojson_path)
-            with open(geojson_path, 'r') as f:
-                neighborhoods_geojson = json.load(f)
-            
-            # Get all open issues with coordinates
-            issues_query = text("""
+            # Get all open issues and user-submitted reports with coordinates
+            # in a single round trip ("label" is the issue descriptor or the
+            # report's severity text, depending on "source")
+            points_query = text("""
                 SELECT
+                    'issue' as source,
                     "Latitude" as latitude,
                     "Longitude" as longitude,
-                    "Descriptor" as descriptor
+                    "Descriptor" as label
                 FROM nyc_street_data
                 WHERE ("Closed Date" = '' OR "Closed Date" IS NULL)
                 AND "Latitude" != ''
                 AND "Longitude" != ''
-            """)
-            
-            # Get user-submitted reports
-            reports_query = text("""
+                UNION ALL
                 SELECT
-                    lat as latitude,
-                    lng as longitude,
-                    severity
+                    'report' as source,
+                    CAST(lat AS TEXT) as latitude,
+                    CAST(lng AS TEXT) as longitude,
+                    CAST(severity AS TEXT) as label
                 FROM reports
             """)
             
-            # Process NYC street data issues
             with db.engine.connect() as conn:
-                result = conn.execute(issues_query)
-                issues = []
+                result = conn.execute(points_query)
+                lats, lngs, severities = [], [], []
                 for row in result:
                     try:
                         lat = float(row.latitude)
                         lng = float(row.longitude)
-                        severity = calculate_severity(row.descriptor)
-                        issues.append({'lat': lat, 'lng': lng, 'severity': severity})
-                    except (ValueError, TypeError):
-                        continue
-                
-                # Process user reports
-                reports_result = conn.execute(reports_query)
-                for row in reports_result:
-                    try:
-                        lat = float(row.latitude)
-                        lng = float(row.longitude)
-                        
-                        # Convert severity string to numeric value
-                        severity_map = {
-                            'none': 1,
-                            'low': 2,
-                            'medium': 3,
-                            'high': 4,
-                            'critical': 5
-                        }
-                        numeric_severity = severity_map.get(row.severity.lower() if row.severity else 'none', 1)
-                        
-                        issues.append({'lat': lat, 'lng': lng, 'severity': numeric_severity})
+                        if row.source == 'issue':
+                            # NYC street data issue
+                            severity = calculate_severity(row.label)
+                        else:
+                            # User report: convert severity string to numeric value
+                            severity = SEVERITY_MAP.get(row.label.lower() if row.label else 'none', 1)
+                        lats.append(lat)
+                        lngs.append(lng)
+                        severities.append(severity)
                     except (ValueError, TypeError):
                         continue
             
+            # Build all issue points in one vectorized call and index them once;
+            # each neighborhood then only tests the points inside its bounding
+            # box instead of every issue in the city
+            severities = np.array(severities)
+            issue_tree = STRtree(shapely.points(lngs, lats))
+            
             # Process each neighborhood
             enriched_neighborhoods = []
             
-            for feature in neighborhoods_geojson['features']:
+            # Polygons are parsed once at startup (app.neighborhoods)
+            for feature, shapely_polygon in app.neighborhoods:
                 neighborhood_name = feature['properties']['neighborhood']
                 borough = feature['properties']['borough']
-                coordinates = feature['geometry']['coordinates']
                 
-                # Create shapely polygon for point-in-polygon testing
-                if feature['geometry']['type'] == 'Polygon':
-                    # Handle simple polygon
-                    polygon_coords = coordinates[0]  # First ring (exterior)
-                    shapely_polygon = ShapelyPolygon([(coord[0], coord[1]) for coord in polygon_coords])
-                else:
-                    # Skip multipolygons for now (could be enhanced later)
-                    continue
-                
-                # Count issues within this neighborhood
-                issues_in_neighborhood = []
-                for issue in issues:
-                    point = Point(issue['lng'], issue['lat'])
-                    if shapely_polygon.contains(point):
-                        issues_in_neighborhood.append(issue)
+                # Indices of the issues within this neighborhood
+                inside = issue_tree.query(shapely_polygon, predicate='contains')
                 
                 # Calculate neighborhood statistics
-                issue_count = len(issues_in_neighborhood)
+                issue_count = len(inside)
                 if issue_count > 0:
-                    severities = [issue['severity'] for issue in issues_in_neighborhood]
-                    avg_severity = sum(severities) / len(severities)
-                    max_severity = max(severities)
+                    neighborhood_severities = severities[inside]
+                    avg_severity = float(neighborhood_severities.mean())
+                    max_severity = int(neighborhood_severities.max())
                     
                     # Calculate risk score similar to grid zones
                     risk_score = (issue_count * avg_severity) / 10
@@ -385,11 +411,14 @@ def create_app():
             # Sort by risk score (highest first)
             enriched_neighborhoods.sort(key=lambda x: x['properties']['risk_score'], reverse=True)
             
-            return jsonify({
+            response = {
                 'type': 'FeatureCollection',
                 'features': enriched_neighborhoods,
                 'count': len(enriched_neighborhoods)
-            })
+            }
+            neighborhood_cache['response'] = response
+            neighborhood_cache['expires_at'] = time.monotonic() + app.config['NEIGHBORHOOD_CACHE_SECONDS']
+            return jsonify(response)
             
         except Exception as e:
             return jsonify({'error': str(e)}), 500
@@ -419,15 +448,7 @@ def create_app():
                 reports = []
                 for row in result:
                     # Map severity string to numeric value for heatmap
-                    severity_map = {
-                        'none': 1,
-                        'low': 2,
-                        'medium': 3,
-                        'high': 4,
-                        'critical': 5
-                    }
-                    
-                    numeric_severity = severity_map.get(row.severity.lower() if row.severity else 'none', 1)
+                    numeric_severity = SEVERITY_MAP.get(row.severity.lower() if row.severity else 'none', 1)
                     
                     reports.append({
                         'id': row.id,
@@ -463,10 +484,12 @@ def create_app():
 
     @app.route("/api/run_cortex", methods=["POST"])
     def run_cortex():
-        from .services.snowflake import safe_normalize_sql, fix_malformed_ilike_patterns
-        
-        data = request.get_json()
+        data = request.get_json(silent=True) or {}
         prompt = data.get("prompt")
+        if not isinstance(prompt, str) or not prompt.strip():
+            return failure_response("prompt must be a non-empty string", 400)
+        # Optional: return {"column": [values...]} instead of a list of row objects
+        columnar = bool(data.get("columnar"))
         complete_prompt = format_prompt(prompt)
 
         headers = {
@@ -494,9 +517,7 @@ def create_app():
 
         # Normalize Snowflake SQL to local Postgres schema using proper functions
         normalized_sql = text.replace("PLOTHOLES.NYC_STREET_DATA.STREET_DATA", "nyc_street_data")
-        normalized_sql = safe_normalize_sql(normalized_sql)
-        normalized_sql = snowflake_to_postgres(normalized_sql)  # Add this line
-        normalized_sql = fix_malformed_ilike_patterns(normalized_sql)
+        normalized_sql = normalize_cortex_sql(normalized_sql)
 
         print("Running normalized SQL:", normalized_sql)
         
@@ -504,8 +525,13 @@ def create_app():
             from sqlalchemy import text as sql_text
             with db.engine.connect() as conn:
                 result = conn.execute(sql_text(normalized_sql))
+                if columnar:
+                    return jsonify({"results": rows_to_columns(list(result.keys()), result)})
                 rows = [dict(row._mapping) for row in result]
             return jsonify({"results": rows})
+        elif columnar:
+            # Column lists from the connector (Arrow when pyarrow is installed)
+            return jsonify({"results": run_sql_columnar(normalized_sql)})
         else:
             results = run_sql(normalized_sql)
             return jsonify({"results": results})
@@ -24,6 +24,17 @@ class Config:
         'max_lng': -73.700272
     }
     
+    # Seconds to reuse a computed /api/neighborhood-boundaries response
+    NEIGHBORHOOD_CACHE_SECONDS = 60
+    
+    # Load and warm up the pothole model in create_app (once per worker) instead
+    # of on the first /api/analyze request. Off by default so workers that never
+    # analyze an image (e.g. when analysis goes to server.py) never import torch.
+    # Leave off when running gunicorn with --preload, so the CUDA context isn't
+    # created before workers fork, and with run.py's reloader, which would load
+    # the model in both processes
+    PRELOAD_MODEL = os.environ.get('PRELOAD_MODEL', 'false').lower() in ('1', 'true', 'yes')
+    
     # API Rate limiting
     RATELIMIT_STORAGE_URL = "memory://"
     
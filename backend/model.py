@@ -1,6 +1,22 @@
+import importlib.util
+import os
+import shutil
+import tempfile
+
+# Every gunicorn worker loads its own model. Left alone, torch/OpenMP and OpenCV
+# (used by ultralytics for letterboxing) each spawn one thread per core in every
+# worker, so W workers x C threads fight over the same cores. Keep each worker
+# single-threaded; set TORCH_NUM_THREADS higher for single-worker deployments.
+# OMP_NUM_THREADS must be set before torch is imported.
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+
+import cv2
 import torch
 import torch.serialization
 
+cv2.setNumThreads(0)
+torch.set_num_threads(int(os.environ.get("TORCH_NUM_THREADS", "1")))
+
 # ✅ allow YOLO model class for PyTorch 2.6+ safe load
 try:
     torch.serialization.add_safe_globals([__import__('ultralytics').nn.tasks.DetectionModel])
@@ -8,213 +24,370 @@ except Exception as e:
     print("[INFO] Safe globals patch not required or already applied:", e)
 
 from ultralyticsplus import YOLO
+from ultralytics import YOLO as UltralyticsYOLO
 import requests
-import os
 from io import BytesIO
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageEnhance
 import numpy as np
 
-print("Loading pothole detection model...")
-model = YOLO("keremberke/yolov8m-pothole-segmentation")
+def _build_tensorrt_engine(ckpt_path, engine_path, imgsz):
+    """
+    Export the checkpoint to a TensorRT FP16 engine at engine_path.
 
-# Enhanced model parameters for better detection
-model.overrides["conf"] = 0.15  # Lower confidence threshold to detect more objects
-model.overrides["iou"] = 0.30    # Lower IoU threshold for better detection of overlapping objects
-model.overrides["agnostic_nms"] = False
-model.overrides["max_det"] = 1000
-model.overrides["imgsz"] = 1280  # Higher resolution for better detection
-model.overrides["device"] = '0' if torch.cuda.is_available() else 'cpu'  # Use GPU if available
+    The export runs on a private copy of the checkpoint in a temp directory
+    next to engine_path and the result is moved into place with os.replace,
+    so workers booting together never load a half-written engine.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix=".engine-build-", dir=os.path.dirname(engine_path))
+    try:
+        tmp_ckpt = os.path.join(tmp_dir, os.path.basename(ckpt_path))
+        shutil.copyfile(ckpt_path, tmp_ckpt)
+        # ultralytics writes the engine next to the weights it was given
+        built_path = UltralyticsYOLO(tmp_ckpt).export(format="engine", imgsz=imgsz, half=True, dynamic=True, batch=8)
+        os.replace(built_path, engine_path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
-def analyze_image(image_path: str, is_url: bool = True):
+def load_tensorrt_engine(pt_model, imgsz=640):
+    """
+    Export the PyTorch weights to a TensorRT FP16 engine and load it.
+
+    The engine is built once and cached next to the downloaded .pt checkpoint,
+    so later boots load it directly. Falls back to the PyTorch model if
+    TensorRT is not installed or the engine can't be built or run; a cached
+    engine that fails its first predict (e.g. built for another GPU or an
+    older TensorRT) is deleted so the next boot rebuilds it.
+    """
+    # Without TensorRT, ultralytics would try to pip-install it during export
+    if importlib.util.find_spec("tensorrt") is None:
+        print("[INFO] TensorRT not installed, using PyTorch weights")
+        return pt_model
+
+    engine_path = os.path.splitext(pt_model.ckpt_path)[0] + ".engine"
     try:
-        # Load image
-        if is_url:
-            print(f"[MODEL] Fetching image from URL: {image_path}")
-            response = requests.get(image_path, stream=True, timeout=10)
-            response.raise_for_status()
-            img = Image.open(BytesIO(response.content)).convert("RGB")
-        else:
-            print(f"[MODEL] Loading local image: {image_path}")
-            if not os.path.exists(image_path):
-                print(f"[ERROR] File not found: {image_path}")
-                return {"pothole": False, "severity": "error", "confidence": 0.0, "error": f"File not found: {image_path}"}
-            img = Image.open(image_path).convert("RGB")
-            
-        # Save a debug copy of the loaded image
+        if not os.path.exists(engine_path):
+            print(f"[INFO] Exporting TensorRT engine to {engine_path} (one-time)...")
+            _build_tensorrt_engine(pt_model.ckpt_path, engine_path, imgsz)
+        # ultralyticsplus only loads .pt / hub ids, so load the engine with plain ultralytics
+        engine = UltralyticsYOLO(engine_path, task=pt_model.task)
+        # The TensorRT backend is only deserialized on the first predict
+        engine.predict(np.zeros((imgsz, imgsz, 3), dtype=np.uint8), imgsz=imgsz, verbose=False)
+        return engine
+    except Exception as e:
+        print("[INFO] TensorRT engine unavailable, using PyTorch weights:", e)
+        try:
+            os.remove(engine_path)
+        except OSError:
+            pass
+        return pt_model
+
+def load_model():
+    """
+    Load the pothole model, apply our inference settings and run one warm-up pass.
+
+    The first predict() initialises the CUDA context, picks cuDNN kernels and
+    sets up the predictor; doing it here keeps that multi-second cost out of
+    the first real request. Call it in the serving process (after the server
+    forks its workers), so each worker gets its own CUDA context.
+    """
+    global MAX_IMGSZ
+    print("Loading pothole detection model...")
+    pt_model = yolo = YOLO("keremberke/yolov8m-pothole-segmentation")
+    if torch.cuda.is_available():
+        # Engine input size matches the primary predict() call in _predict
+        yolo = load_tensorrt_engine(pt_model, imgsz=ENGINE_IMGSZ)
+        # Input shapes repeat (letterboxed to imgsz), so let cuDNN benchmark once and reuse
+        torch.backends.cudnn.benchmark = True
+    if yolo is not pt_model:
+        # The engine profile is fixed at ENGINE_IMGSZ and can't run larger inputs
+        MAX_IMGSZ = ENGINE_IMGSZ
+
+    # Enhanced model parameters for better detection
+    yolo.overrides["conf"] = 0.15  # Lower confidence threshold to detect more objects
+    yolo.overrides["iou"] = 0.30    # Lower IoU threshold for better detection of overlapping objects
+    yolo.overrides["agnostic_nms"] = False
+    yolo.overrides["max_det"] = 1000
+    yolo.overrides["imgsz"] = MAX_IMGSZ  # Higher resolution for better detection
+    yolo.overrides["device"] = '0' if torch.cuda.is_available() else 'cpu'  # Use GPU if available
+    yolo.overrides["half"] = torch.cuda.is_available()  # FP16 on GPU; no INT8/FP8 quantization for this conv model
+
+    # Warm-up pass
+    yolo.predict(np.zeros((640, 640, 3), dtype=np.uint8), imgsz=640, verbose=False)
+    print("[INFO] Pothole detection model loaded and warmed up")
+    return yolo
+
+# Input size the TensorRT engine is exported for
+ENGINE_IMGSZ = 640
+
+# Largest imgsz passed to predict(); load_model lowers it to ENGINE_IMGSZ
+# when the TensorRT engine is in use
+MAX_IMGSZ = 1280
+
+# model.py is imported inside each worker process: by create_app when
+# PRELOAD_MODEL is set, otherwise lazily by the /api/analyze handler (or by
+# the model server itself)
+model = load_model()
+
+# Largest batch sent to the model in one forward pass (matches the TensorRT engine profile)
+MAX_BATCH = 8
+
+# Largest image side we keep after decoding. This is the biggest imgsz ever passed
+# to predict(), and the model letterboxes down to it anyway, so anything larger
+# (e.g. 4032x3024 phone photos) is just extra pixels to decode, copy and resize.
+MAX_INPUT_SIDE = 1280
+
+def _error_result(message):
+    return {"pothole": False, "severity": "error", "confidence": 0.0, "error": message}
+
+def _open_image(source):
+    """
+    Open an image as RGB, downscaled so its longest side is at most MAX_INPUT_SIDE.
+
+    Returns: (PIL image, original (width, height))
+    """
+    img = Image.open(source)
+    original_size = img.size
+    # JPEGs can be decoded directly at 1/2, 1/4 or 1/8 scale (never below the requested size)
+    img.draft("RGB", (MAX_INPUT_SIDE, MAX_INPUT_SIDE))
+    img = img.convert("RGB")
+    if max(img.size) > MAX_INPUT_SIDE:
+        img.thumbnail((MAX_INPUT_SIDE, MAX_INPUT_SIDE))
+    return img, original_size
+
+def _prepare_image(image_path: str, is_url: bool, save_debug: bool = True):
+    """
+    Load an image and build the inputs used for prediction.
+
+    save_debug: write the debug_*.jpg / processed_image.jpg files to the working
+    directory. These are fixed file names, so only do it for single-image calls.
+
+    Returns: (PIL image, numpy array, (x, y) factors mapping boxes back to original pixels)
+    """
+    # Load image
+    if is_url:
+        print(f"[MODEL] Fetching image from URL: {image_path}")
+        response = requests.get(image_path, stream=True, timeout=10)
+        response.raise_for_status()
+        img, original_size = _open_image(BytesIO(response.content))
+    else:
+        print(f"[MODEL] Loading local image: {image_path}")
+        if not os.path.exists(image_path):
+            print(f"[ERROR] File not found: {image_path}")
+            raise FileNotFoundError(f"File not found: {image_path}")
+        img, original_size = _open_image(image_path)
+
+    box_scale = (original_size[0] / img.width, original_size[1] / img.height)
+        
+    if save_debug:
+        # Save a debug copy of the loaded image. Encode the JPEG once and reuse
+        # the bytes for both debug files instead of encoding the image twice.
+        jpeg_buf = BytesIO()
+        img.save(jpeg_buf, format="JPEG")
+        debug_jpeg = jpeg_buf.getvalue()
         debug_img_path = "debug_loaded_image.jpg"
-        img.save(debug_img_path)
+        with open(debug_img_path, "wb") as f:
+            f.write(debug_jpeg)
         print(f"[DEBUG] Loaded image saved to {debug_img_path}")
-        print(f"[DEBUG] Image size: {img.size}, mode: {img.mode}")
-        
-        # Convert to numpy array for model input
-        import numpy as np
-        img_np = np.array(img)
-        print(f"[DEBUG] Numpy array shape: {img_np.shape}, dtype: {img_np.dtype}")
-        
-        if img_np.size == 0:
-            print("[ERROR] Loaded image is empty")
-            return {"pothole": False, "severity": "error", "confidence": 0.0, "error": "Loaded image is empty"}
-            
-        print(f"[MODEL] Image loaded. Size: {img.size}, Mode: {img.mode}")
+    print(f"[DEBUG] Image size: {img.size} (original {original_size}), mode: {img.mode}")
+    
+    # Convert to numpy array for model input
+    img_np = np.array(img)
+    print(f"[DEBUG] Numpy array shape: {img_np.shape}, dtype: {img_np.dtype}")
+    
+    if img_np.size == 0:
+        print("[ERROR] Loaded image is empty")
+        raise ValueError("Loaded image is empty")
         
+    print(f"[MODEL] Image loaded. Size: {img.size}, Mode: {img.mode}")
+    
+    if save_debug:
         # Save original image for debugging
         debug_img_path = "debug_image.jpg"
-        img.save(debug_img_path)
+        with open(debug_img_path, "wb") as f:
+            f.write(debug_jpeg)
         print(f"[DEBUG] Original image saved to {debug_img_path}")
         
-        # Preprocess image - enhance contrast
-        from PIL import ImageEnhance
-        
-        # Convert to grayscale for better edge detection
+        # Preprocess image - enhance contrast (debug output only; the model
+        # gets the RGB image). Convert to grayscale for better edge detection
         gray_img = img.convert('L')
         
         # Enhance contrast
         enhancer = ImageEnhance.Contrast(gray_img)
-        enhanced_img = enhancer.enhance(2.0)  # Increase contrast
-        
-        # Convert back to RGB for the model
-        processed_img = enhanced_img.convert('RGB')
+        processed_img = enhancer.enhance(2.0)  # Increase contrast
         
-        # Save processed image for debugging
+        # Save processed image for debugging (JPEG stores grayscale directly,
+        # no need to expand it back to a 3-channel RGB buffer)
         processed_img_path = "processed_image.jpg"
         processed_img.save(processed_img_path)
         print(f"[DEBUG] Processed image saved to {processed_img_path}")
+
+    return img, img_np, box_scale
+
+def _try_prepare_image(image_path: str, is_url: bool, save_debug: bool = True):
+    """Same as _prepare_image, but returns an error result dict instead of raising."""
+    try:
+        return _prepare_image(image_path, is_url, save_debug)
+    except Exception as e:
+        print(f"[ERROR] analyze_image failed: {str(e)}")
+        return _error_result(str(e))
+
+def _predict(images_np, images_pil):
+    """
+    Run one batched prediction, retrying the whole batch with looser
+    settings if the model returns nothing.
+    """
+    # First try with minimal parameters
+    results = model.predict(
+        images_np,  # Use the numpy arrays directly
+        conf=0.1,      # Very low confidence threshold
+        iou=0.3,       # Lower IoU threshold
+        imgsz=ENGINE_IMGSZ,  # Try smaller size first
+        augment=False,  # Disable augmentation for now
+        verbose=True    # More detailed output
+    )
+    
+    # If no results, try with different parameters
+    if results is None or len(results) == 0:
+        print("[WARNING] No results with initial parameters, trying with different settings...")
+        results = model.predict(
+            images_np,
+            conf=0.05,     # Even lower confidence
+            iou=0.25,      # Lower IoU
+            imgsz=MAX_IMGSZ,  # Higher resolution
+            augment=True,  # Try with augmentation
+            verbose=True
+        )
+        
+    # If still no results, try with the original images
+    if results is None or len(results) == 0:
+        print("[WARNING] Still no results, trying with original image...")
+        results = model.predict(
+            images_pil,  # Try with PIL Images
+            conf=0.05,
+            iou=0.25,
+            imgsz=MAX_IMGSZ,
+            augment=True,
+            verbose=True
+        )
+
+    return results
+
+def _summarize_result(result, box_scale=(1.0, 1.0)):
+    """
+    Turn a single model result into the API response dict.
+
+    box_scale: (x, y) factors mapping boxes from the downscaled model input
+    back to the original image pixels
+    """
+    # Check if we have any detections
+    if not hasattr(result, 'boxes') or result.boxes is None:
+        print("[WARNING] No boxes in results")
+        return {
+            "pothole": False, 
+            "severity": "none", 
+            "confidence": 0.0, 
+            "message": "No detections in the image"
+        }
+        
+    # Get detections
+    boxes = result.boxes
+    if boxes is None or len(boxes) == 0:
+        print("[INFO] No potholes detected in the image")
+        return {
+            "pothole": False, 
+            "severity": "none", 
+            "confidence": 0.0, 
+            "message": "No potholes detected"
+        }
+        
+    # Convert boxes to numpy array
+    boxes_np = boxes.xyxy.cpu().numpy()  # Get boxes in xyxy format
+    boxes_np = boxes_np * np.array([box_scale[0], box_scale[1], box_scale[0], box_scale[1]])
+    confs = boxes.conf.cpu().numpy()     # Get confidence scores
+    
+    if len(confs) == 0:
+        print("[INFO] No potholes detected after filtering")
+        return {
+            "pothole": False, 
+            "severity": "none", 
+            "confidence": 0.0, 
+            "message": "No potholes detected after filtering"
+        }
+        
+    avg_conf = float(np.mean(confs))
+    num_detections = len(confs)
+    
+    print(f"[MODEL] Found {num_detections} potholes, average confidence: {avg_conf:.2f}")
+    print(f"[MODEL] Confidence scores: {[round(c, 2) for c in confs]}")
+    
+    # Calculate severity
+    if num_detections < 2 or avg_conf < 0.2:
+        severity = "minor"
+    elif num_detections < 5 or avg_conf < 0.4:
+        severity = "moderate"
+    else:
+        severity = "severe"
         
-        # Run prediction with minimal parameters first
-        print("[MODEL] Running prediction...")
+    return {
+        "pothole": True,
+        "severity": severity,
+        "confidence": round(avg_conf, 2),
+        "detections": num_detections,
+        "boxes": boxes_np.tolist()
+    }
+
+def analyze_images(image_paths, is_url: bool = True):
+    """
+    Analyze several images with a single batched forward pass per MAX_BATCH images.
+
+    Images are downloaded/decoded in parallel threads (network and image
+    decoding release the GIL). Returns one result dict per path, in order.
+    """
+    if not image_paths:
+        return []
+
+    # Debug files have fixed names; concurrent loader threads would clobber each other
+    save_debug = len(image_paths) == 1
+
+    with ThreadPoolExecutor(max_workers=min(MAX_BATCH, len(image_paths))) as pool:
+        prepared = list(pool.map(lambda path: _try_prepare_image(path, is_url, save_debug), image_paths))
+
+    outputs = [p if isinstance(p, dict) else None for p in prepared]
+    pending = [i for i, p in enumerate(prepared) if not isinstance(p, dict)]
+
+    for start in range(0, len(pending), MAX_BATCH):
+        batch = pending[start:start + MAX_BATCH]
         try:
-            # First try with minimal parameters
-            results = model.predict(
-                img_np,  # Use the numpy array directly
-                conf=0.1,      # Very low confidence threshold
-                iou=0.3,       # Lower IoU threshold
-                imgsz=640,     # Try smaller size first
-                augment=False,  # Disable augmentation for now
-                verbose=True    # More detailed output
+            print(f"[MODEL] Running prediction on {len(batch)} image(s)...")
+            results = _predict(
+                [prepared[i][1] for i in batch],
+                [prepared[i][0] for i in batch]
             )
-            
-            # If no results, try with different parameters
-            if results is None or len(results) == 0:
-                print("[WARNING] No results with initial parameters, trying with different settings...")
-                results = model.predict(
-                    img_np,
-                    conf=0.05,     # Even lower confidence
-                    iou=0.25,      # Lower IoU
-                    imgsz=1280,    # Higher resolution
-                    augment=True,  # Try with augmentation
-                    verbose=True
-                )
-                
-            # If still no results, try with the original image
-            if results is None or len(results) == 0:
-                print("[WARNING] Still no results, trying with original image...")
-                results = model.predict(
-                    img,  # Try with PIL Image
-                    conf=0.05,
-                    iou=0.25,
-                    imgsz=1280,
-                    augment=True,
-                    verbose=True
-                )
-                
+
             if results is None or len(results) == 0:
                 print("[WARNING] No potholes detected with any parameters")
-                return {
-                    "pothole": False,
-                    "severity": "none",
-                    "confidence": 0.0,
-                    "message": "No potholes detected with current model settings"
-                }
-            
-            print(f"[MODEL] Prediction complete. Results type: {type(results)}")
-            
-            if results is None or len(results) == 0:
-                print("[WARNING] No results returned from model prediction")
-                # Try with a simpler prediction
-                results = model.predict(processed_img, conf=0.1, verbose=True)
-                
-                if results is None or len(results) == 0:
-                    return {
-                        "pothole": False, 
-                        "severity": "none", 
-                        "confidence": 0.0, 
-                        "message": "Model returned no results"
+                for i in batch:
+                    outputs[i] = {
+                        "pothole": False,
+                        "severity": "none",
+                        "confidence": 0.0,
+                        "message": "No potholes detected with current model settings"
                     }
-            
-            # Check if we have any detections
-            if not hasattr(results[0], 'boxes') or results[0].boxes is None:
-                print("[WARNING] No boxes in results")
-                return {
-                    "pothole": False, 
-                    "severity": "none", 
-                    "confidence": 0.0, 
-                    "message": "No detections in the image"
-                }
-                
-            # Get detections
-            boxes = results[0].boxes
-            if boxes is None or len(boxes) == 0:
-                print("[INFO] No potholes detected in the image")
-                return {
-                    "pothole": False, 
-                    "severity": "none", 
-                    "confidence": 0.0, 
-                    "message": "No potholes detected"
-                }
-                
-            # Convert boxes to numpy array
-            boxes_np = boxes.xyxy.cpu().numpy()  # Get boxes in xyxy format
-            confs = boxes.conf.cpu().numpy()     # Get confidence scores
-            
-            if len(confs) == 0:
-                print("[INFO] No potholes detected after filtering")
-                return {
-                    "pothole": False, 
-                    "severity": "none", 
-                    "confidence": 0.0, 
-                    "message": "No potholes detected after filtering"
-                }
-                
-            avg_conf = float(np.mean(confs))
-            num_detections = len(confs)
-            
-            print(f"[MODEL] Found {num_detections} potholes, average confidence: {avg_conf:.2f}")
-            print(f"[MODEL] Confidence scores: {[round(c, 2) for c in confs]}")
-            
-            # Calculate severity
-            if num_detections < 2 or avg_conf < 0.2:
-                severity = "minor"
-            elif num_detections < 5 or avg_conf < 0.4:
-                severity = "moderate"
-            else:
-                severity = "severe"
-                
-            return {
-                "pothole": True,
-                "severity": severity,
-                "confidence": round(avg_conf, 2),
-                "detections": num_detections,
-                "boxes": boxes_np.tolist()
-            }
-            
+                continue
+
+            print(f"[MODEL] Prediction complete. Results type: {type(results)}")
+            for i, result in zip(batch, results):
+                outputs[i] = _summarize_result(result, prepared[i][2])
+
         except Exception as e:
             print(f"[ERROR] Error during prediction: {str(e)}")
             import traceback
             traceback.print_exc()
-            return {
-                "pothole": False, 
-                "severity": "error", 
-                "confidence": 0.0, 
-                "error": f"Prediction error: {str(e)}"
-            }
-            
-    except Exception as e:
-        print(f"[ERROR] analyze_image failed: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return {
-            "pothole": False, 
-            "severity": "error", 
-            "confidence": 0.0, 
-            "error": str(e)
-        }
+            for i in batch:
+                outputs[i] = _error_result(f"Prediction error: {str(e)}")
+
+    return outputs
+
+def analyze_image(image_path: str, is_url: bool = True):
+    return analyze_images([image_path], is_url=is_url)[0]
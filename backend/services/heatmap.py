@@ -1,3 +1,6 @@
+import functools
+import re
+
 descriptors = {"cave-in", "unsafe worksite", "crash cushion defect",
         "guard rail - street", "plate condition - open",
         "blocked - construction",  "line/marking - faded",
@@ -6,59 +9,78 @@ descriptors = {"cave-in", "unsafe worksite", "crash cushion defect",
         "wear & tear", "defective hardware", "defacement",
         "dumpster - construction waste",}
 
-def calculate_severity(descriptor):
-    """Calculate severity score (1–5) based on descriptor text"""
-
+# Descriptor keyword tiers, checked from most to least severe
+_SEVERITY_TIERS = [
     # Highest severity (5) — immediate hazards or unsafe conditions
-    high_severity = [
+    (5, [
         "cave-in",
         "unsafe worksite",
         "crash cushion defect",
         "guard rail - street",
         "plate condition - open",
         "blocked - construction",
-    ]
+    ]),
 
     # Medium-high severity (4) — structural or major damage issues
-    medium_high = [
+    (4, [
         "pothole",
         "depression maintenance",
         "failed street repair",
         "plate condition - shifted",
         "hummock",
         "rough, pitted or cracked roads",
-    ]
+    ]),
 
     # Medium severity (3) — surface or marking problems
-    medium = [
+    (3, [
         "line/marking - faded",
         "line/marking - after repaving",
         "strip paving",
         "plate condition - anti-skid",
         "plate condition - noisy",
         "wear & tear",
-    ]
+    ]),
 
     # Low severity (2) — mostly cosmetic or non-urgent issues
-    low = [
+    (2, [
         "defective hardware",
         "defacement",
         "dumpster - construction waste",
-    ]
+    ]),
+]
+
+# Keyword -> severity, flattened once from the tiers above
+_SEVERITY_BY_TERM = {
+    term.lower(): severity
+    for severity, terms in _SEVERITY_TIERS
+    for term in terms
+}
+
+# Every keyword compiled into one alternation, most severe first. The
+# lookahead reports a match at every position (overlapping terms included),
+# so a single scan of the text finds all keywords
+_SEVERITY_PATTERN = re.compile(
+    "(?=(" + "|".join(re.escape(term) for term in _SEVERITY_BY_TERM) + "))"
+)
+
+_MAX_SEVERITY = max(_SEVERITY_BY_TERM.values())
+
+# Descriptors come from a small fixed vocabulary, so most calls repeat
+@functools.lru_cache(maxsize=512)
+def calculate_severity(descriptor):
+    """Calculate severity score (1–5) based on descriptor text"""
 
     text = (descriptor or "").lower().strip()
 
-    if any(term.lower() in text for term in high_severity):
-        return 5
-    elif any(term.lower() in text for term in medium_high):
-        return 4
-    elif any(term.lower() in text for term in medium):
-        return 3
-    elif any(term.lower() in text for term in low):
-        return 2
-    else:
-        # Default minimal severity if no match
-        return 1
+    # Default minimal severity if no match
+    best = 1
+    for match in _SEVERITY_PATTERN.finditer(text):
+        severity = _SEVERITY_BY_TERM[match.group(1)]
+        best = best if best >= severity else severity
+        if best == _MAX_SEVERITY:
+            break
+
+    return best
 
 
 def create_heatmap():
@@ -2,36 +2,108 @@ from ..models.BlockedEdges import BlockedEdges
 # from backend.app import create_app
 import osmnx as ox
 import networkx as nx
-import matplotlib as plot
+import numpy as np
 import os
+import pickle
 
-def get_shortest_path(graph, orig_node, dest_node, blocked_edges_set):
+# Edge attribute holding the precomputed routing weight (see apply_edge_weights)
+SAFE_WEIGHT = 'safe_weight'
+
+def apply_edge_weights(graph, blocked_edges_set):
+    """
+    Precompute the routing weight of every edge once, so shortest-path search
+    reads a plain edge attribute instead of calling back into Python per edge.
+
+    graph: full OSMnx graph (edited in place)
+    blocked_edges_set: cached set of blocked (u, v, key) edges from database
+    """
+    for u, v, k, data in graph.edges(keys=True, data=True):
+        if (u, v, k) in blocked_edges_set:
+            data[SAFE_WEIGHT] = float('inf')  # hard block
+        else:
+            # Use travel_time if available, else fallback to length
+            data[SAFE_WEIGHT] = data.get('travel_time', data.get('length', 1))
+
+def block_edge(graph, u, v, k):
+    """
+    Mark a single edge as blocked after apply_edge_weights has run.
+    """
+    graph.edges[u, v, k][SAFE_WEIGHT] = float('inf')
+
+def get_shortest_path(graph, orig_node, dest_node):
     """
     Compute the shortest path on a given OSMnx graph, avoiding blocked edges.
 
-    graph: OSMnx graph
+    graph: OSMnx graph with weights from apply_edge_weights
     origin_point: nearest node to origin lat/lon
     destination_point: nearest node to destination lat/lon
-    blocked_edges_set: cached set of blocked edges from database
 
     Returns: path (list of node IDs)
     """
-    # --- 1) Define a custom weight function that avoids blocked edges ---
-    def weight(u, v, data):
-        if (u, v, 0) in blocked_edges_set:
-            return float('inf')  # hard block
-        # Use travel_time if available, else fallback to length
-        return data.get('travel_time', data.get('length', 1))
-
-    # --- 2) Compute shortest path ---
     try:
-        path = nx.shortest_path(graph, source=orig_node, target=dest_node, weight=weight)
+        path = nx.shortest_path(graph, source=orig_node, target=dest_node, weight=SAFE_WEIGHT)
         return path
     except nx.NetworkXNoPath:
         print("No available path avoiding blocked edges.")
         return None
     
-def get_subgraph(graph, origin_point, destination_point, margin=0.02):
+def load_or_build_graph(graphml_path):
+    """
+    Load the OSMnx graph, reusing a pickled copy saved next to the GraphML.
+
+    Parsing the GraphML XML takes seconds for NYC; unpickling the already
+    typed graph is much faster. The pickle is rebuilt whenever the GraphML
+    file is newer than it or it can't be loaded. Its name includes the
+    networkx version, so an upgrade starts from a fresh pickle.
+
+    Returns: OSMnx MultiDiGraph
+    """
+    pickle_path = f"{os.path.splitext(graphml_path)[0]}.nx{nx.__version__}.pkl"
+
+    if os.path.exists(pickle_path) and os.path.getmtime(pickle_path) >= os.path.getmtime(graphml_path):
+        try:
+            with open(pickle_path, 'rb') as f:
+                graph = pickle.load(f)
+            if not isinstance(graph, nx.MultiDiGraph):
+                raise TypeError(f"expected MultiDiGraph, got {type(graph).__name__}")
+            return graph
+        except Exception as e:
+            # e.g. pickled by an older Python/networkx/osmnx; rebuild it below
+            print(f"Could not load cached graph at {pickle_path}, rebuilding: {e}")
+
+    graph = ox.load_graphml(graphml_path)
+
+    # Write to a temp file first so a crashed or concurrent boot never
+    # leaves a truncated pickle behind
+    tmp_path = f"{pickle_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(graph, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, pickle_path)
+    except OSError as e:
+        print(f"Could not cache graph at {pickle_path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return graph
+
+def build_node_index(graph):
+    """
+    Builds flat arrays of node IDs and coordinates for fast bounding-box lookups.
+    Build once per graph (the graph is static) and pass to get_subgraph.
+
+    graph: OSMnx graph
+
+    Returns: (node_ids, coords) where coords[i] is (lat, lon) of node_ids[i]
+    """
+    nodes = list(graph.nodes(data=True))
+    node_ids = np.array([n for n, _ in nodes], dtype=np.int64)
+    # float32 (~1 m precision at NYC's latitude) is plenty for a padded
+    # bounding box and halves the bytes scanned per lookup
+    coords = np.array([(d['y'], d['x']) for _, d in nodes], dtype=np.float32)
+    return node_ids, coords
+
+def get_subgraph(graph, origin_point, destination_point, margin=0.02, node_index=None):
     """
     Returns a subgraph containing nodes near the origin and destination.
 
@@ -39,23 +111,29 @@ def get_subgraph(graph, origin_point, destination_point, margin=0.02):
     origin_point: (lat, lon)
     destination_point: (lat, lon)
     margin: extra padding in degrees (~0.01 ≈ 1 km)
+    node_index: cached result of build_node_index(graph); built on the fly if omitted
 
-    Returns: subgraph (NetworkX MultiDiGraph)
+    Returns: subgraph (read-only NetworkX MultiDiGraph view of graph)
     """
+    if node_index is None:
+        node_index = build_node_index(graph)
+    node_ids, coords = node_index
+
     # Determine bounding box
     min_lat = min(origin_point[0], destination_point[0]) - margin
     max_lat = max(origin_point[0], destination_point[0]) + margin
     min_lon = min(origin_point[1], destination_point[1]) - margin
     max_lon = max(origin_point[1], destination_point[1]) + margin
 
-    # Get nodes within bounding box
-    nodes = [
-        n for n, d in graph.nodes(data=True)
-        if min_lat <= d['y'] <= max_lat and min_lon <= d['x'] <= max_lon
-    ]
+    # Get nodes within bounding box (one vectorized mask instead of a Python loop over every node)
+    lats = coords[:, 0]
+    lons = coords[:, 1]
+    mask = (lats >= min_lat) & (lats <= max_lat) & (lons >= min_lon) & (lons <= max_lon)
+    nodes = node_ids[mask].tolist()
 
-    # Return subgraph
-    return graph.subgraph(nodes).copy()
+    # Return subgraph as a view; routing only reads it, so copying every
+    # node/edge attribute dict would be wasted work
+    return graph.subgraph(nodes)
 
 def convert_latlon_to_node(graph, point):
     """
@@ -88,6 +166,9 @@ def visualize_large(graph, route):
         print("No route created")
 
 def visualize_zoomed(graph, route, origin_node, destination_node):
+    # Debug-only helper: import matplotlib here so the API never loads it
+    import matplotlib.pyplot as plt
+
     # Get node coordinates for the route
     route_xs = [graph.nodes[n]['x'] for n in route]
     route_ys = [graph.nodes[n]['y'] for n in route]
@@ -113,27 +194,27 @@ def visualize_zoomed(graph, route, origin_node, destination_node):
     ax.scatter(graph.nodes[origin_node]['x'], graph.nodes[origin_node]['y'], c='green', s=100, zorder=5)
     ax.scatter(graph.nodes[destination_node]['x'], graph.nodes[destination_node]['y'], c='blue', s=100, zorder=5)
 
-    plot.pyplot.show()
+    plt.show()
  
-def compute_final_route(graph, origin, destination, blocked_edges_set):
+def compute_final_route(graph, origin, destination, node_index=None):
     """
     High-level function to get shortest route in lat/lon coordinates.
 
     origin, destination: tuples (lat, lon)
-    blocked_edges_set: set of blocked edges (cached)
-    graph: full OSMnx graph
+    graph: full OSMnx graph with weights from apply_edge_weights
+    node_index: cached build_node_index(graph) result (optional)
 
     Returns: list of (lat, lon) tuples or None
     """
     # Find subgraph around origin/destination
-    subgraph = get_subgraph(graph, origin, destination, margin=0.02)
+    subgraph = get_subgraph(graph, origin, destination, margin=0.02, node_index=node_index)
 
     # Find the node on the graph closest to this longitude and latitudes
     origin_node = convert_latlon_to_node(subgraph, origin)
     dest_node = convert_latlon_to_node(subgraph, destination)
 
     # Get the shortest path that avoids blocked streets
-    route_nodes = get_shortest_path(subgraph, orig_node=origin_node, dest_node=dest_node, blocked_edges_set=blocked_edges_set)
+    route_nodes = get_shortest_path(subgraph, orig_node=origin_node, dest_node=dest_node)
 
     if not route_nodes:
         return None
@@ -153,7 +234,8 @@ def compute_final_route(graph, origin, destination, blocked_edges_set):
 #         # Load in graph of map
 #         BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 #         GRAPH_PATH = os.path.join(BASE_DIR, 'data', 'nyc_graphml.graphml')
-#         nyc_graph = ox.load_graphml(GRAPH_PATH)
+#         nyc_graph = load_or_build_graph(GRAPH_PATH)
+#         apply_edge_weights(nyc_graph, blocked_edges_set)
 
 #         # Define latitude and longitude of origin and destination
 #         origin = (40.681722, -73.832725)
@@ -167,7 +249,7 @@ def compute_final_route(graph, origin, destination, blocked_edges_set):
 #         dest_node = convert_latlon_to_node(subgraph, destination)
 
 #         # Get the shortest path that avoids blocked streets
-#         route = get_shortest_path(subgraph, orig_node=origin_node, dest_node=dest_node, blocked_edges_set=blocked_edges_set)
+#         route = get_shortest_path(subgraph, orig_node=origin_node, dest_node=dest_node)
 
 #         # # Create large visualization
 #         # visualize_large(nyc_graph, route)
@@ -189,7 +271,7 @@ def compute_final_route(graph, origin, destination, blocked_edges_set):
 #         dest_node = convert_latlon_to_node(subgraph, destination)
 
 #         # Get the shortest path that avoids blocked streets
-#         route = get_shortest_path(subgraph, orig_node=origin_node, dest_node=dest_node, blocked_edges_set=blocked_edges_set)
+#         route = get_shortest_path(subgraph, orig_node=origin_node, dest_node=dest_node)
 
 #         # # Create large visualization
 #         # visualize_large(nyc_graph, route)
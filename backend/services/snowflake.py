@@ -1,235 +1,460 @@
-import json
-import sseclient
+import atexit
+import functools
+import logging
 import snowflake.connector
 import os
+import threading
 from dotenv import load_dotenv
 
 import re
 
+logger = logging.getLogger(__name__)
+
+# orjson parses the small per-delta SSE payloads several times faster; it is optional
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
+# -------------------------------
+# Precompiled SQL rewrite patterns
+# -------------------------------
+
+# Text columns whose strict equality is loosened to ILIKE
+_TEXT_COL_PATTERNS = [
+    (col, re.compile(rf'"{col}"\s*=\s*\'([^\']+)\'', re.IGNORECASE))
+    for col in ["Descriptor", "Complaint Type", "Status", "Borough"]
+]
+
+# Uppercase Snowflake columns -> local quoted Postgres names
+_COLUMN_MAPPING = {
+    "BOROUGH": '"Borough"',
+    "DESCRIPTOR": '"Descriptor"',
+    "COMPLAINT_TYPE": '"Complaint Type"',
+    "INCIDENT_ZIP": '"Incident Zip"',
+    "INCIDENT_ADDRESS": '"Incident Address"',
+    "STREET_NAME": '"Street Name"',
+    "STATUS": '"Status"',
+    "CREATED_DATE": '"Created Date"',
+    "CLOSED_DATE": '"Closed Date"',
+    "UNIQUE_KEY": '"Unique Key"',
+    "LATITUDE": '"Latitude"',
+    "LONGITUDE": '"Longitude"',
+    "LOCATION_TYPE": '"Location Type"',
+    "DUE_DATE": '"Due Date"',
+    "RESOLUTION_DESCRIPTION": '"Resolution Description"'
+}
+# All column names in one alternation (longest first), so each segment is
+# scanned once instead of once per column
+_COLMAP_RE = re.compile(
+    r'\b(' + '|'.join(re.escape(k) for k in sorted(_COLUMN_MAPPING, key=len, reverse=True)) + r')\b',
+    re.IGNORECASE
+)
+
+# Case-sensitive twin for code that is already all uppercase ASCII, which is
+# how Cortex emits identifiers; exact matching skips per-character case folding
+_COLMAP_CS_RE = re.compile(_COLMAP_RE.pattern)
+
+def _colmap_repl(m):
+    # casefold first: IGNORECASE also matches look-alikes such as the Kelvin sign
+    return _COLUMN_MAPPING[m.group(1).casefold().upper()]
+
+# One token per single-quoted literal (a trailing unterminated one included)
+# or per run of SQL code between literals
+_SQL_TOKEN_RE = re.compile(r"'[^']*'?|[^']+")
+
+# '%%'text'%%' and '%'text'%' → '%text%'
+_DOUBLE_PCT = re.compile(r"'%%'\s*'([^']+?)'\s*'%%'")
+_SINGLE_PCT = re.compile(r"'%'\s*'([^']+?)'\s*'%'")
+# '%%text%%' → '%text%'
+_PADDED_PCT = re.compile(r"'%%+([^']*?)%%+'")
+
+# ILIKE "text" → ILIKE 'text'
+_ILIKE_DQ = re.compile(r"ILIKE\s+\"([^\"]+)\"")
+
+# Snowflake YEAR()/MONTH()/DAY() on the text "Created Date" column, or a stray
+# EXTRACT(... FROM "Created Date") missing its TO_TIMESTAMP, in one alternation
+_DATE_PART_RE = re.compile(
+    r'\b(YEAR|MONTH|DAY)\s*\(\s*("Created Date"|CREATED_DATE)\s*\)'
+    r'|EXTRACT\((YEAR|MONTH|DAY)\s+FROM\s+"Created Date"\)',
+    re.IGNORECASE
+)
+
+def _strip_pct_repl(m):
+    return f"'%{m.group(1).strip()}%'"
+
+def _map_columns(code):
+    if code.isascii() and code.upper() == code:
+        return _COLMAP_CS_RE.sub(_colmap_repl, code)
+    return _COLMAP_RE.sub(_colmap_repl, code)
+
+def _map_code_columns(m):
+    tok = m.group(0)
+    return tok if tok[0] == "'" else _map_columns(tok)
+
+def _fix_split_pct_literals(sql):
+    # '%%'text'%%' and '%'text'%' → '%text%'
+    if "'%%'" in sql:
+        sql = _DOUBLE_PCT.sub(_strip_pct_repl, sql)
+    if "'%'" in sql:
+        sql = _SINGLE_PCT.sub(_strip_pct_repl, sql)
+    return sql
+
+def _collapse_literal_pcts(m):
+    tok = m.group(0)
+    if tok[0] != "'":
+        return tok
+    # Loop so runs of three or more percents also end up as one
+    while "%%" in tok:
+        tok = tok.replace("%%", "%")
+    return tok
+
+def _date_part_repl(m):
+    if m.group(1):
+        # YEAR() → EXTRACT(YEAR FROM TO_TIMESTAMP("Created Date", 'MM/DD/YYYY HH12:MI:SS AM'))
+        return f"EXTRACT({m.group(1).upper()} FROM TO_TIMESTAMP({m.group(2)}, 'MM/DD/YYYY HH12:MI:SS AM'))"
+    # Stray EXTRACT not wrapped correctly
+    return f"EXTRACT({m.group(3)} FROM TO_TIMESTAMP(\"Created Date\", 'MM/DD/YYYY HH12:MI:SS AM'))"
+
 def relax_equals_to_ilike(sql: str) -> str:
     """
     Loosens strict equality for known text columns so partial matches still return data.
     Converts e.g.  "Descriptor" = 'Severe'  →  "Descriptor" ILIKE '%Severe%'.
     """
-    text_cols = ["Descriptor", "Complaint Type", "Status", "Borough"]
-    for col in text_cols:
-        pattern = rf'"{col}"\s*=\s*\'([^\']+)\''
-        sql = re.sub(pattern, rf'"{col}" ILIKE \'%\1%\'', sql, flags=re.IGNORECASE)
+    # Every rewrite needs an equality against a quoted column
+    if '=' not in sql:
+        return sql
+
+    for col, pattern in _TEXT_COL_PATTERNS:
+        sql = pattern.sub(rf'"{col}" ILIKE \'%\1%\'', sql)
+    return sql
+
+def _map_columns_outside_literals(sql):
+    # ONLY replace column names outside of string literals
+    # (one tokenizing pass; string literals are passed through untouched)
+    if "'" in sql:
+        return _SQL_TOKEN_RE.sub(_map_code_columns, sql)
+    # No string literals: the whole query is code
+    return _map_columns(sql)
+
+def _trim_padded_pcts(sql):
+    # '%%text%%' → '%text%'
+    if "%%" in sql:
+        sql = _PADDED_PCT.sub(lambda m: f"'%{m.group(1)}%'", sql)
+    return sql
+
+def _fix_ilike_double_quotes(sql):
+    # ILIKE "text" → ILIKE 'text'
+    if 'ILIKE' in sql:
+        sql = _ILIKE_DQ.sub(lambda m: f"ILIKE '{m.group(1)}'", sql)
+    return sql
+
+def _convert_date_parts(sql):
+    # Every form needs a date part name; skip the regex when none is present
+    sql_upper = sql.upper()
+    if 'YEAR' in sql_upper or 'MONTH' in sql_upper or 'DAY' in sql_upper:
+        sql = _DATE_PART_RE.sub(_date_part_repl, sql)
+    return sql
+
+def _collapse_pcts(sql):
+    # Collapse redundant %% to a single % within quoted strings only
+    if "%%" in sql:
+        sql = _SQL_TOKEN_RE.sub(_collapse_literal_pcts, sql)
     return sql
 
 def safe_normalize_sql(sql: str) -> str:
     """
     Normalize Snowflake-style SQL to match local Postgres table schema.
-    Fixes column names and malformed ILIKE string patterns.
+    Maps column names outside string literals, repairs split and double-quoted
+    ILIKE patterns, and trims redundant %% padding from quoted strings.
     """
+    # Each step is guarded by a plain substring test, which is far cheaper
+    # than running its regex on SQL that cannot match
+
     # Step 1 — Map uppercase Snowflake columns to local quoted names
-    # ONLY replace column names outside of string literals
-    mapping = {
-        "BOROUGH": '"Borough"',
-        "DESCRIPTOR": '"Descriptor"',
-        "COMPLAINT_TYPE": '"Complaint Type"',
-        "INCIDENT_ZIP": '"Incident Zip"',
-        "INCIDENT_ADDRESS": '"Incident Address"',
-        "STREET_NAME": '"Street Name"',
-        "STATUS": '"Status"',
-        "CREATED_DATE": '"Created Date"',
-        "CLOSED_DATE": '"Closed Date"',
-        "UNIQUE_KEY": '"Unique Key"',
-        "LATITUDE": '"Latitude"',
-        "LONGITUDE": '"Longitude"',
-        "LOCATION_TYPE": '"Location Type"',
-        "DUE_DATE": '"Due Date"',
-        "RESOLUTION_DESCRIPTION": '"Resolution Description"'
-    }
-    
-    # Split SQL by single quotes to separate string literals from code
-    parts = sql.split("'")
-    for i in range(len(parts)):
-        # Only process even indices (outside string literals)
-        # Odd indices are inside string literals - leave them alone
-        if i % 2 == 0:
-            for snow_col, pg_col in mapping.items():
-                # Use word boundaries and case-sensitive matching outside strings
-                parts[i] = re.sub(
-                    rf'\b{snow_col}\b',
-                    pg_col,
-                    parts[i],
-                    flags=re.IGNORECASE
-                )
-    
-    # Rejoin with single quotes
-    sql = "'".join(parts)
+    sql = _map_columns_outside_literals(sql)
 
     # Step 2 — Fix malformed ILIKE patterns (if any exist after column mapping)
-    # Pattern 1: '%%'text'%%' → '%text%'
-    sql = re.sub(
-        r"'%%'\s*'([^']+?)'\s*'%%'",
-        lambda m: f"'%{m.group(1).strip()}%'",
-        sql
-    )
-    
-    # Pattern 2: '%'text'%' → '%text%'
-    sql = re.sub(
-        r"'%'\s*'([^']+?)'\s*'%'",
-        lambda m: f"'%{m.group(1).strip()}%'",
-        sql
-    )
+    # '%%'text'%%' and '%'text'%' → '%text%'
+    sql = _fix_split_pct_literals(sql)
 
     # Step 3 — Remove redundant double percents within quoted strings
-    sql = re.sub(r"'%%+([^']*?)%%+'", lambda m: f"'%{m.group(1)}%'", sql)
+    sql = _trim_padded_pcts(sql)
 
     # Step 4 — Ensure single quotes around strings (no weird double quoting)
-    sql = re.sub(r"ILIKE\s+\"([^\"]+)\"", lambda m: f"ILIKE '{m.group(1)}'", sql)
+    return _fix_ilike_double_quotes(sql)
 
-    return sql
+def normalize_cortex_sql(sql: str) -> str:
+    """
+    Convert Cortex-generated Snowflake SQL for the local Postgres schema:
+    the safe_normalize_sql steps plus YEAR()/MONTH()/DAY() conversion on the
+    text "Created Date" column.
+    """
+    sql = _map_columns_outside_literals(sql)
+    mapped = sql
+    sql = _fix_split_pct_literals(sql)
+    sql = _trim_padded_pcts(sql)
+    sql = _fix_ilike_double_quotes(sql)
+    sql = _convert_date_parts(sql)
 
-def fix_malformed_ilike_patterns(sql: str) -> str:
+    # Only a rewrite above can leave new split '%' literals behind
+    if sql != mapped:
+        sql = _fix_split_pct_literals(sql)
+
+    return _collapse_pcts(sql)
+
+@functools.lru_cache(maxsize=1)
+def _get_config():
     """
-    Final cleanup pass to fix any malformed ILIKE patterns that may have been
-    introduced by previous transformations.
+    Snowflake connection config, read from the environment on first use.
+    Loads .env only when the variables are not already set (e.g. by the host).
     """
-    # Fix pattern: '%%'text'%%' → '%text%'
-    # This specifically targets the broken pattern with quotes breaking up strings
-    sql = re.sub(
-        r"'%%'\s*'([^']+?)'\s*'%%'",
-        lambda m: f"'%{m.group(1).strip()}%'",
-        sql
-    )
-    
-    # Fix pattern: '%'text'%' → '%text%'
-    sql = re.sub(
-        r"'%'\s*'([^']+?)'\s*'%'",
-        lambda m: f"'%{m.group(1).strip()}%'",
-        sql
-    )
-
-    # Remove redundant double percents within quoted strings (but only within single quotes)
-    sql = re.sub(r"'%%+([^']*?)%%+'", lambda m: f"'%{m.group(1)}%'", sql)
-    
-    # Clean up any remaining %% to single % within quoted strings only
-    parts = sql.split("'")
-    for i in range(1, len(parts), 2):  # Only odd indices (inside strings)
-        parts[i] = parts[i].replace("%%", "%")
-    sql = "'".join(parts)
+    if not os.getenv("SNOWFLAKE_USER"):
+        load_dotenv()
+
+    return {
+        "user": os.getenv("SNOWFLAKE_USER"),
+        "password": os.getenv("SNOWFLAKE_PASSWORD"),
+        "account": os.getenv("SNOWFLAKE_ACCOUNT"),
+        "role": os.getenv("SNOWFLAKE_ROLE"),
+        "warehouse": os.getenv("SNOWFLAKE_WAREHOUSE"),
+        "database": os.getenv("SNOWFLAKE_DATABASE"),
+        "schema": os.getenv("SNOWFLAKE_SCHEMA")
+    }
 
-    return sql
+# One connection shared by all requests; connecting (TLS + auth) costs far
+# more than a typical query
+_connection = None
+_connection_lock = threading.Lock()
 
-def snowflake_to_postgres(sql: str) -> str:
-    """
-    Convert Snowflake-specific SQL functions to PostgreSQL equivalents,
-    and handle text-based datetime columns like "Created Date".
-    """
-    # YEAR() → EXTRACT(YEAR FROM TO_TIMESTAMP("Created Date", 'MM/DD/YYYY HH12:MI:SS AM'))
-    sql = re.sub(
-        r'\bYEAR\s*\(\s*("Created Date"|CREATED_DATE)\s*\)',
-        r"EXTRACT(YEAR FROM TO_TIMESTAMP(\1, 'MM/DD/YYYY HH12:MI:SS AM'))",
-        sql,
-        flags=re.IGNORECASE
-    )
-
-    # MONTH() → EXTRACT(MONTH FROM TO_TIMESTAMP("Created Date", 'MM/DD/YYYY HH12:MI:SS AM'))
-    sql = re.sub(
-        r'\bMONTH\s*\(\s*("Created Date"|CREATED_DATE)\s*\)',
-        r"EXTRACT(MONTH FROM TO_TIMESTAMP(\1, 'MM/DD/YYYY HH12:MI:SS AM'))",
-        sql,
-        flags=re.IGNORECASE
-    )
-
-    # DAY() → EXTRACT(DAY FROM TO_TIMESTAMP("Created Date", 'MM/DD/YYYY HH12:MI:SS AM'))
-    sql = re.sub(
-        r'\bDAY\s*\(\s*("Created Date"|CREATED_DATE)\s*\)',
-        r"EXTRACT(DAY FROM TO_TIMESTAMP(\1, 'MM/DD/YYYY HH12:MI:SS AM'))",
-        sql,
-        flags=re.IGNORECASE
-    )
-
-    # (Optional) Catch any stray EXTRACTs not wrapped correctly and fix them
-    sql = re.sub(
-        r'EXTRACT\((YEAR|MONTH|DAY)\s+FROM\s+"Created Date"\)',
-        r"EXTRACT(\1 FROM TO_TIMESTAMP(\"Created Date\", 'MM/DD/YYYY HH12:MI:SS AM'))",
-        sql,
-        flags=re.IGNORECASE
-    )
+# Snowflake errnos for an expired session / master token (raised as ProgrammingError)
+_SESSION_EXPIRED_ERRNOS = {390112, 390114}
 
-    return sql
+def _get_connection():
+    """
+    Return the shared Snowflake connection, connecting on first use or after it was closed.
+    """
+    global _connection
+    with _connection_lock:
+        if _connection is None or _connection.is_closed():
+            # Heartbeats keep the session (and its token) alive while the
+            # process sits idle between queries
+            _connection = snowflake.connector.connect(**_get_config(), client_session_keep_alive=True)
+        return _connection
+
+def _reset_connection(ctx):
+    """
+    Drop a connection that failed so the next call reconnects.
+    """
+    global _connection
+    with _connection_lock:
+        if _connection is ctx:
+            _connection = None
+    try:
+        ctx.close()
+    except snowflake.connector.errors.Error:
+        pass
 
-# Load environment variables from .env
-load_dotenv()
-
-# Snowflake connection config
-SNOWFLAKE_CONFIG = {
-    "user": os.getenv("SNOWFLAKE_USER"),
-    "password": os.getenv("SNOWFLAKE_PASSWORD"),
-    "account": os.getenv("SNOWFLAKE_ACCOUNT"),
-    "role": os.getenv("SNOWFLAKE_ROLE"),
-    "warehouse": os.getenv("SNOWFLAKE_WAREHOUSE"),
-    "database": os.getenv("SNOWFLAKE_DATABASE"),
-    "schema": os.getenv("SNOWFLAKE_SCHEMA")
-}
+def _is_connection_error(e):
+    """
+    True for errors that mean the connection itself is unusable: network
+    failures (OperationalError), SQLSTATE class 08 (connection exception)
+    and expired session/master tokens.
+    """
+    if isinstance(e, snowflake.connector.errors.OperationalError):
+        return True
+    return (e.sqlstate or "").startswith("08") or e.errno in _SESSION_EXPIRED_ERRNOS
 
-def parse_cortex_sse(resp):
+@atexit.register
+def _close_connection():
+    if _connection is not None and not _connection.is_closed():
+        _connection.close()
+
+def _iter_sse_data(resp, chunk_size=65536):
     """
-    Parse a Cortex SSE streaming response and return the full text.
+    Yield the data payload of each event in a server-sent events response.
+    Reads the body in large byte chunks and frames events on blank lines.
     """
-    full_text = ""
+    pending = b""
+    data_lines = []
+
+    for chunk in resp.iter_content(chunk_size=chunk_size):
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()  # incomplete last line, finished by the next chunk
 
-    if resp.status_code < 400:
-        client = sseclient.SSEClient(resp)
+        for line in lines:
+            line = line.rstrip(b"\r")
 
-        for event in client.events():
-            if not event.data or event.data.strip() in ["[DONE]", ""]:
+            # A blank line ends the current event
+            if not line:
+                if data_lines:
+                    yield b"\n".join(data_lines).decode("utf-8")
+                    data_lines = []
                 continue
 
-            try:
-                parsed = json.loads(event.data)
-                delta = parsed.get("choices", [{}])[0].get("delta", {})
+            # Only data fields matter here; event/id/retry/comments are skipped
+            if line.startswith(b"data:"):
+                value = line[5:]
+                if value.startswith(b" "):
+                    value = value[1:]
+                data_lines.append(value)
+
+    # Flush an event left unterminated at the end of the stream
+    line = pending.rstrip(b"\r")
+    if line.startswith(b"data:"):
+        value = line[5:]
+        data_lines.append(value[1:] if value.startswith(b" ") else value)
+    if data_lines:
+        yield b"\n".join(data_lines).decode("utf-8")
+
+def stream_cortex_sse(resp):
+    """
+    Yield the text of each delta in a Cortex SSE streaming response as it arrives.
+    """
+    if resp.status_code >= 400:
+        return
+
+    for data in _iter_sse_data(resp):
+        if data.strip() in ["[DONE]", ""]:
+            continue
 
-                # grab either 'text' or 'content' depending on which is present
-                chunk_text = delta.get("text") or delta.get("content")
-                if chunk_text:
-                    full_text += chunk_text
+        try:
+            parsed = _json_loads(data)
+            delta = parsed.get("choices", [{}])[0].get("delta", {})
 
-            except json.JSONDecodeError:
-                # skip non-JSON lines
-                continue
-            except (IndexError, KeyError):
-                continue
+            # grab either 'text' or 'content' depending on which is present
+            chunk_text = delta.get("text") or delta.get("content")
+            if chunk_text:
+                yield chunk_text
 
-    return full_text
+        except ValueError:
+            # skip non-JSON lines (json and orjson decode errors are ValueErrors)
+            continue
+        except (IndexError, KeyError):
+            continue
 
-def run_sql(raw_sql: str):
+def parse_cortex_sse(resp):
     """
-    Cleans and executes a SQL query in Snowflake using env config.
+    Parse a Cortex SSE streaming response and return the full text.
+    """
+    return "".join(stream_cortex_sse(resp))
+
+def _prepare_sql(raw_sql: str) -> str:
+    """
+    Clean up raw SQL text and normalize it for the local column names.
     """
     sql = " ".join(raw_sql.strip().splitlines()).rstrip(";")
 
-    print("BEFORE safe_normalize_sql:", sql)
+    # Lazy %s formatting: the SQL is only rendered when debug logging is on
+    logger.debug("BEFORE safe_normalize_sql: %s", sql)
     
     # Normalize SQL syntax for Postgres-like compatibility
     sql = safe_normalize_sql(sql)
     
-    print("AFTER safe_normalize_sql:", sql)
+    logger.debug("AFTER safe_normalize_sql: %s", sql)
     
     sql = relax_equals_to_ilike(sql)
     
-    print("AFTER relax_equals_to_ilike:", sql)
+    logger.debug("AFTER relax_equals_to_ilike: %s", sql)
+
+    return sql
 
-    ctx = None
-    cs = None
+def _execute(sql: str, fetch):
+    """
+    Run sql on the shared connection and return fetch(cursor).
+    """
+    for attempt in range(2):
+        ctx = _get_connection()
+        try:
+            with ctx.cursor() as cs:
+                cs.execute(sql)
+                return fetch(cs)
+        except snowflake.connector.errors.DatabaseError as e:
+            if not _is_connection_error(e):
+                raise
+            # Stale session (e.g. expired login): reconnect and retry once
+            _reset_connection(ctx)
+            if attempt:
+                raise
+
+def _fetch_dicts(cs):
+    columns = tuple(col[0] for col in cs.description)
+    # Iterate the cursor directly so rows stream from the result
+    # batches instead of first being copied into a fetchall list
+    return [dict(zip(columns, row)) for row in cs]
+
+def rows_to_columns(columns, rows):
+    """
+    Transpose result rows into {column: [values]}.
+    """
+    values = list(zip(*rows)) or [()] * len(columns)
+    return {col: list(vals) for col, vals in zip(columns, values)}
+
+def _fetch_columns(cs):
+    # pyarrow is only needed for columnar requests, so import it here rather
+    # than in every process that loads this module
     try:
-        ctx = snowflake.connector.connect(**SNOWFLAKE_CONFIG)
-        cs = ctx.cursor()
-        cs.execute(sql)
-        columns = [col[0] for col in cs.description]
-        rows = cs.fetchall()
-        return [dict(zip(columns, row)) for row in rows]
-    finally:
-        if cs:
-            cs.close()
-        if ctx:
-            ctx.close()
+        import pyarrow
+    except ImportError:
+        # No pyarrow: transpose the row results instead
+        return rows_to_columns(tuple(col[0] for col in cs.description), cs)
+    return cs.fetch_arrow_all(force_return_table=True).to_pydict()
+
+def run_sql(raw_sql: str):
+    """
+    Cleans and executes a SQL query in Snowflake using env config.
+    """
+    return _execute(_prepare_sql(raw_sql), _fetch_dicts)
+
+def run_sql_columnar(raw_sql: str):
+    """
+    Same as run_sql, but returns {column: [values]} instead of a list of row
+    dicts. Built from the connector's Arrow result when pyarrow is installed.
+    """
+    return _execute(_prepare_sql(raw_sql), _fetch_columns)
+
+# NLQ prompt with a single {user_query} placeholder, split at import so
+# format_prompt only concatenates the query between the two static halves
+_NLQ_TEMPLATE = """You are an AI that converts **natural language requests into SQL** for Postgres. Generate **syntactically correct SQL** for the user request that will run in Postgres without errors. Be precise, efficient, and include only needed columns.
+    
+    ## Database Metadata
+    - Table: PLOTHOLES.NYC_STREET_DATA.STREET_DATA
+    - Columns: UNIQUE_KEY, CREATED_DATE, CLOSED_DATE, AGENCY, COMPLAINT_TYPE, DESCRIPTOR, LOCATION_TYPE, INCIDENT_ZIP, STREET_NAME, BOROUGH, LATITUDE, LONGITUDE, STATUS, DUE_DATE, RESOLUTION_DESCRIPTION, LOCATION
+    - Table contains NYC 311 street condition service requests in the year 2025
+    
+    ## User Request
+
+    "{user_query}"
 
+    ## Instructions
+    ## CRITICAL Data Structure Notes:
+    - **COMPLAINT_TYPE** contains the general category (e.g., "Street Condition")
+    - **DESCRIPTOR** contains the specific issue type like 'Pothole', 'Cave-in', 'Defective Hardware', 'Rough, Pitted or Cracked Roads', etc.
+    - When users ask about potholes, road damage, cave-ins, etc., search the DESCRIPTOR column
+    - The DESCRIPTOR column also indicates severity: 'Pothole', 'Cave-in', 'Severe Condition', etc.
 
+    ## Severity Mapping (for DESCRIPTOR):
+    - 'Severe' or 'Critical' or 'Cave-in' → 5
+    - 'High' or 'Major' → 4
+    - 'Medium', 'Moderate' → 3
+    - 'Low', 'Minor', 'Slight', 'Pothole' → 2
+    - others → 1
+
+    - Generate **syntactically correct SQL** that will run in Postgres without errors
+    - When filtering by issue type (pothole, cave-in, etc.), use the DESCRIPTOR column
+    - Use ILIKE '%keyword%' for flexible text matching
+    - When the user asks for “most severe”, “worst”, or “highest severity”, **calculate** severity from the descriptors, don’t filter for 'Severe'.
+    - Group by borough and return counts or averages of severity.
+    - Generate **syntactically correct SQL** for the user request that will run in Postgres without errors. Be precise, efficient, and include only needed columns.
+    - Only use columns listed above.
+    - Apply filters, aggregation, or sorting if implied.
+    - Use proper Postgres SQL syntax.
+    - Output **only SQL**, no explanations.
+"""
+_PROMPT_PRE, _, _PROMPT_POST = _NLQ_TEMPLATE.partition("{user_query}")
+
+# Dashboards re-send identical questions; reuse the already built prompt string
+@functools.lru_cache(maxsize=1024)
 def format_prompt(user_query: str):
     """
     Prompt for Snowflake Cortex GenAI, formatted with the necessary context & user query
@@ -330,41 +555,4 @@ def format_prompt(user_query: str):
 # - Output **only the SQL code**, no explanations or commentary.  
 # - If the user request is ambiguous and could map to multiple interpretations, choose the one most consistent with the metadata provided.
 # """
-    nlq_prompt = f"""You are an AI that converts **natural language requests into SQL** for Postgres. Generate **syntactically correct SQL** for the user request that will run in Postgres without errors. Be precise, efficient, and include only needed columns.
-    
-    ## Database Metadata
-    - Table: PLOTHOLES.NYC_STREET_DATA.STREET_DATA
-    - Columns: UNIQUE_KEY, CREATED_DATE, CLOSED_DATE, AGENCY, COMPLAINT_TYPE, DESCRIPTOR, LOCATION_TYPE, INCIDENT_ZIP, STREET_NAME, BOROUGH, LATITUDE, LONGITUDE, STATUS, DUE_DATE, RESOLUTION_DESCRIPTION, LOCATION
-    - Table contains NYC 311 street condition service requests in the year 2025
-    
-    ## User Request
-
-    "{user_query}"
-
-    ## Instructions
-    ## CRITICAL Data Structure Notes:
-    - **COMPLAINT_TYPE** contains the general category (e.g., "Street Condition")
-    - **DESCRIPTOR** contains the specific issue type like 'Pothole', 'Cave-in', 'Defective Hardware', 'Rough, Pitted or Cracked Roads', etc.
-    - When users ask about potholes, road damage, cave-ins, etc., search the DESCRIPTOR column
-    - The DESCRIPTOR column also indicates severity: 'Pothole', 'Cave-in', 'Severe Condition', etc.
-
-    ## Severity Mapping (for DESCRIPTOR):
-    - 'Severe' or 'Critical' or 'Cave-in' → 5
-    - 'High' or 'Major' → 4
-    - 'Medium', 'Moderate' → 3
-    - 'Low', 'Minor', 'Slight', 'Pothole' → 2
-    - others → 1
-
-    - Generate **syntactically correct SQL** that will run in Postgres without errors
-    - When filtering by issue type (pothole, cave-in, etc.), use the DESCRIPTOR column
-    - Use ILIKE '%keyword%' for flexible text matching
-    - When the user asks for “most severe”, “worst”, or “highest severity”, **calculate** severity from the descriptors, don’t filter for 'Severe'.
-    - Group by borough and return counts or averages of severity.
-    - Generate **syntactically correct SQL** for the user request that will run in Postgres without errors. Be precise, efficient, and include only needed columns.
-    - Only use columns listed above.
-    - Apply filters, aggregation, or sorting if implied.
-    - Use proper Postgres SQL syntax.
-    - Output **only SQL**, no explanations.
-"""
-    
-    return nlq_prompt
+    return _PROMPT_PRE + user_query + _PROMPT_POST